@@ -11,8 +11,10 @@ LLM-based анализатор (интегрирован под текущую 
 Требуется: OPENAI_API_KEY; pip install -r requirements.txt
 """
 
-import os, re, json, math, hashlib, argparse, time, random
+import os, re, json, math, hashlib, argparse, time, random, threading
 import httpx, pandas as pd, yaml
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from typing import List, Dict, Any
 from tqdm import tqdm
@@ -28,6 +30,11 @@ RES_PATH = ART_DIR / "comprehensive_results.json"
 STATS_PATH = ART_DIR / "statistics.json"
 TAX_PATH = "taxonomy.yaml"
 
+# Сколько диалогов отправлять в LLM одновременно (запросы сетевые — потоков достаточно)
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+# Сколько ответов LLM держать в памяти для одинаковых окон (temperature=0)
+RESPONSE_CACHE_SIZE = 4096
+
 # Потоковая запись результатов
 OUT_DIR = Path("out")
 OUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -50,9 +57,14 @@ def load_state():
     return {}
 
 def save_state(state):
-    STATE_PATH.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
-    if hasattr(os, "sync"):
-        os.sync()
+    # Чекпойнт пишется после каждого окна: компактно, атомарно (tmp + replace)
+    # и с fsync только этого файла, а не os.sync() всей системы
+    tmp = STATE_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, STATE_PATH)
 
 # ----------------- чтение, парсинг, client-only -----------------
 def read_dialogs(path: str) -> pd.DataFrame:
@@ -63,10 +75,11 @@ def read_dialogs(path: str) -> pd.DataFrame:
     return df[["dialog_id","full_text"]]
 
 # Поддержка вариантов ролей и разделителей (":" или "-")
-ROLE_PATTERNS = {
-    "client": re.compile(r"^(?:Клиент|Покупатель)\s*[:\-]\s*(.*)$", re.IGNORECASE),
-    "operator": re.compile(r"^(?:Оператор|Менеджер)\s*[:\-]\s*(.*)$", re.IGNORECASE),
-}
+# Одна якорная альтернация вместо двух match на строку; группа client задаёт роль
+ROLE_RE = re.compile(
+    r"^(?:(?P<client>Клиент|Покупатель)|Оператор|Менеджер)\s*[:\-]\s*(?P<text>.*)$",
+    re.IGNORECASE,
+)
 
 def split_turns(full_text: str) -> List[Dict[str,Any]]:
     turns = []
@@ -75,14 +88,11 @@ def split_turns(full_text: str) -> List[Dict[str,Any]]:
         raw = str(raw).strip()
         if not raw:
             continue
-        m_client = ROLE_PATTERNS["client"].match(raw)
-        m_oper = ROLE_PATTERNS["operator"].match(raw)
-        if m_client:
-            role = "client"; text = m_client.group(1).strip()
-        elif m_oper:
-            role = "operator"; text = m_oper.group(1).strip()
-        else:
+        m = ROLE_RE.match(raw)
+        if not m:
             continue
+        role = "client" if m.group("client") else "operator"
+        text = m.group("text").strip()
         tid += 1
         turns.append({"turn_id": tid, "role": role, "text": text})
     return turns
@@ -90,6 +100,9 @@ def split_turns(full_text: str) -> List[Dict[str,Any]]:
 def client_only_windows(turns: List[Dict[str,Any]], whole_max_tokens=8000, window_tokens=1800):
     # оценка токенов ~ символы/4
     client_turns = [t for t in turns if t["role"] == "client"]
+    if not client_turns:
+        # клиент не сказал ни слова — окна пустые, звать LLM незачем
+        return []
     total_chars = sum(len(t["text"]) for t in client_turns)
     if math.ceil(total_chars/4) <= whole_max_tokens:
         return [{"mode":"whole","window_id":0,"turns":client_turns}]
@@ -109,6 +122,8 @@ def format_for_prompt(window) -> str:
     return "\n".join([f"[{t['turn_id']}] {t['text']}" for t in window["turns"]])
 
 # ----------------- LLM экстракция -----------------
+TURN_REF_RE = re.compile(r"\[(\d+)\]")
+
 SYSTEM = (
     "Ты извлекаешь только из слов КЛИЕНТА. Верни ОДИН JSON-ОБЪЕКТ вида "
     '{"mentions":[{...}]}. Для каждого упоминания ключи: '
@@ -123,14 +138,27 @@ USER_TMPL = (
 )
 
 class LLM:
-    def __init__(self, model="gpt-4o-mini", timeout=120):
+    def __init__(self, model="gpt-4o-mini", timeout=120, concurrency=MAX_CONCURRENCY):
         self.model = model
         self.key = os.getenv("OPENAI_API_KEY", "")
         self.client = httpx.Client(
             http2=True,
             timeout=httpx.Timeout(connect=10.0, read=180.0, write=30.0, pool=None),
-            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            limits=httpx.Limits(max_connections=max(10, concurrency), max_keepalive_connections=max(5, concurrency)),
         )
+        # Таксономия — статичный префикс промпта (после SYSTEM, до окна диалога).
+        # Читаем один раз: байты префикса совпадают во всех запросах прогона,
+        # и OpenAI переиспользует закэшированный префикс (prompt caching).
+        with open(TAX_PATH, "r", encoding="utf-8") as f:
+            self.taxonomy_json = json.dumps(yaml.safe_load(f), ensure_ascii=False)
+        # Шаблон рендерим один раз вокруг {window}: на вызов остаётся конкатенация
+        head, tail = USER_TMPL.split("{window}")
+        self._user_head = head.format(taxonomy=self.taxonomy_json)
+        self._user_tail = tail.format()
+        # Точный кэш ответов: короткие однотипные окна ("алло", "да, спасибо")
+        # повторяются между звонками — не платим за них повторно
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
     def _post_with_retry(self, path: str, json: dict, max_retries: int = 6, base_sleep: float = 1.5):
         headers = {
@@ -151,21 +179,24 @@ class LLM:
                 code = e.response.status_code
                 if code in (429, 500, 502, 503, 504):
                     sleep = min(60.0, (base_sleep ** attempt) + random.uniform(0, 0.5))
+                    # Сервер сам говорит, когда повторять: раньше — гарантированный 429
+                    try:
+                        sleep = min(60.0, max(sleep, float(e.response.headers.get("retry-after", 0))))
+                    except ValueError:
+                        pass
                     print(f"⚠️  {code} от сервера (попытка {attempt}/{max_retries}). Повтор через {sleep:.1f}s…")
                     time.sleep(sleep)
                 else:
                     raise
         raise RuntimeError("Превышено число повторов запроса")
 
-    def extract(self, dialog_id: str, window) -> List[Dict[str,Any]]:
-        if not self.key:
-            raise RuntimeError("ENV OPENAI_API_KEY не задан")
-        with open(TAX_PATH, "r", encoding="utf-8") as f:
-            taxonomy = yaml.safe_load(f)
-        user = USER_TMPL.format(
-            taxonomy=json.dumps(taxonomy, ensure_ascii=False),
-            window=format_for_prompt(window),
-        )
+    def _complete(self, user: str) -> str:
+        key = hashlib.blake2b(f"{self.model}\x00{user}".encode("utf-8"), digest_size=16).digest()
+        with self._cache_lock:
+            content = self._cache.get(key)
+            if content is not None:
+                self._cache.move_to_end(key)
+                return content
         payload = {
             "model": self.model,
             "temperature": 0,
@@ -180,11 +211,25 @@ class LLM:
             json=payload,
         )
         content = data["choices"][0]["message"]["content"]
+        with self._cache_lock:
+            self._cache[key] = content
+            if len(self._cache) > RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return content
+
+    def extract(self, dialog_id: str, window) -> List[Dict[str,Any]]:
+        if not self.key:
+            raise RuntimeError("ENV OPENAI_API_KEY не задан")
+        user = self._user_head + format_for_prompt(window) + self._user_tail
+        content = self._complete(user)
+        # Невалидный JSON или не тот формат — сразу пусто, без разбора
         try:
-            js = json.loads(content)
-            arr = js.get("mentions", [])
-        except Exception:
-            arr = []
+            arr = json.loads(content).get("mentions")
+        except (TypeError, ValueError, AttributeError):
+            # TypeError — content=null (отказ модели)
+            return []
+        if not isinstance(arr, list):
+            return []
         out = []
         for m in arr:
             if not isinstance(m, dict):
@@ -195,8 +240,8 @@ class LLM:
             turn_id = m.get("turn_id")
             try:
                 turn_id = int(turn_id)
-            except:
-                mt = re.search(r"\[(\d+)\]", text_quote)
+            except (TypeError, ValueError):
+                mt = TURN_REF_RE.search(text_quote)
                 turn_id = int(mt.group(1)) if mt else 0
             out.append({
                 "dialog_id": dialog_id,
@@ -210,8 +255,10 @@ class LLM:
         return out
 
 # ----------------- дедуп -----------------
+WS_RE = re.compile(r"\s+")
+
 def norm_quote(s: str) -> str:
-    return re.sub(r"\s+", " ", s.strip().lower())
+    return WS_RE.sub(" ", s.strip().lower())
 
 def dedup_mentions(rows: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
     seen = set(); out = []
@@ -222,7 +269,7 @@ def dedup_mentions(rows: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
             r["label_type"],
             r["theme"],
             r.get("subtheme"),
-            hashlib.md5(norm_quote(r["text_quote"]).encode()).hexdigest(),
+            hashlib.blake2b(norm_quote(r["text_quote"]).encode(), digest_size=8).digest(),
         )
         if key in seen:
             continue
@@ -230,74 +277,106 @@ def dedup_mentions(rows: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
     return out
 
 # ----------------- основной прогон -----------------
-def run(model="gpt-4o-mini", whole_max=8000, window_tokens=1800):
+def run(model="gpt-4o-mini", whole_max=8000, window_tokens=1800, concurrency=MAX_CONCURRENCY):
     df = read_dialogs(INPUT_XLSX)
-    llm = LLM(model=model)
+    llm = LLM(model=model, concurrency=concurrency)
     
     total_dialogs = len(df)
     print(f"🚀 Начинаем анализ {total_dialogs} диалогов...")
-    print(f"📊 Модель: {model}, окно: {window_tokens} токенов")
+    print(f"📊 Модель: {model}, окно: {window_tokens} токенов, параллельно: {concurrency}")
     
     # Загружаем состояние для resume
     state = load_state()
     print(f"📋 Состояние: {len(state)} диалогов уже обработано")
     
-    start_time = time.time()
-    
-    # Прогресс-бар для диалогов
-    with tqdm(total=total_dialogs, desc="📞 Анализ диалогов", unit="диалог") as pbar:
-        for idx, row in df.iterrows():
-            dlg_id = row["dialog_id"]
-            turns = split_turns(row["full_text"])
+    # Окна одного диалога идут по порядку (resume по last_window),
+    # разные диалоги — параллельно; запись и состояние — под замком
+    lock = threading.Lock()
+    # Ctrl-C: работающие потоки бросают диалог после текущего окна
+    stop = threading.Event()
+    # Счётчик найденного ведём на ходу, а не перечитываем растущий JSONL
+    total_mentions = 0
+    if OUT_JSONL.exists():
+        with open(OUT_JSONL, "r", encoding="utf-8") as f:
+            total_mentions = sum(1 for _ in f)
+
+    # строки с одним dialog_id — одна задача: у них общий resume-state,
+    # поэтому идут друг за другом, как в последовательном прогоне
+    dialogs: Dict[str, List[str]] = {}
+    for dlg_id, text in zip(df["dialog_id"], df["full_text"]):
+        dialogs.setdefault(dlg_id, []).append(text)
+
+    def process_dialog(dlg_id, texts):
+        nonlocal total_mentions
+        for text in texts:
             windows = client_only_windows(
-                turns, whole_max_tokens=whole_max, window_tokens=window_tokens
+                split_turns(text), whole_max_tokens=whole_max, window_tokens=window_tokens
             )
-            
-            # Проверяем, нужно ли обрабатывать этот диалог
-            dialog_state = state.get(str(dlg_id), {})
-            start_from = dialog_state.get("last_window", -1) + 1
-            
-            if start_from >= len(windows):
-                pbar.update(1)
-                continue
-                
-            # Обрабатываем окна для текущего диалога с обработкой ошибок
-            try:
-                for window_idx, w in enumerate(windows):
-                    if window_idx < start_from:
-                        continue
-                        
-                    new_mentions = llm.extract(dlg_id, w)
+            # Проверяем, с какого окна продолжать этот диалог
+            with lock:
+                start_from = state.get(str(dlg_id), {}).get("last_window", -1) + 1
+            for window_idx in range(start_from, len(windows)):
+                if stop.is_set():
+                    return
+                new_mentions = llm.extract(dlg_id, windows[window_idx])
+                with lock:
                     append_mentions(new_mentions)
-                    
-                    # Обновляем состояние
+                    total_mentions += len(new_mentions)
                     state[str(dlg_id)] = {"last_window": window_idx}
                     save_state(state)
-                    
+    
+    start_time = time.perf_counter()
+    done = 0
+
+    def collect(finished):
+        nonlocal done
+        for fut in finished:
+            dlg_id, n_rows = pending.pop(fut)
+            # Ошибка в диалоге не останавливает прогон
+            try:
+                fut.result()
             except Exception as e:
                 print(f"\n⚠️  Ошибка в диалоге {dlg_id}: {e}")
                 print("🔄 Пропускаем диалог и продолжаем...")
             
             # Обновляем прогресс
-            pbar.update(1)
+            pbar.update(n_rows)
+            prev, done = done, done + n_rows
             
             # Показываем статистику каждые 50 диалогов
-            if (idx + 1) % 50 == 0:
-                elapsed = time.time() - start_time
-                rate = (idx + 1) / elapsed
-                eta = (total_dialogs - idx - 1) / rate if rate > 0 else 0
-                
-                # Подсчитываем общее количество упоминаний
-                total_mentions = sum(1 for _ in open(OUT_JSONL)) if OUT_JSONL.exists() else 0
+            if done // 50 > prev // 50:
+                elapsed = time.perf_counter() - start_time
+                rate = done / elapsed * 60
+                eta = (total_dialogs - done) / rate if rate > 0 else 0
                 
                 pbar.set_postfix({
                     'найдено': total_mentions,
                     'скорость': f'{rate:.1f} диал/мин',
-                    'осталось': f'{eta/60:.1f} мин'
+                    'осталось': f'{eta:.1f} мин'
                 })
 
+    # Прогресс-бар для диалогов; в работе не больше concurrency*2 задач,
+    # чтобы остановка не дожидалась всей очереди
+    max_in_flight = concurrency * 2
+    pending = {}
+    with tqdm(total=total_dialogs, desc="📞 Анализ диалогов", unit="диалог") as pbar, \
+            ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            for dlg_id, texts in dialogs.items():
+                pending[pool.submit(process_dialog, dlg_id, texts)] = (dlg_id, len(texts))
+                if len(pending) >= max_in_flight:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        except BaseException:
+            # прогресс уже в progress.json — продолжим с того же места
+            stop.set()
+            for fut in pending:
+                fut.cancel()
+            raise
+
     # Финальная статистика
-    total_time = time.time() - start_time
+    total_time = time.perf_counter() - start_time
     print(f"\n✅ Анализ завершен за {total_time/60:.1f} минут")
     print(f"📊 Скорость: {total_dialogs/(total_time/60):.1f} диалогов/минуту")
     
@@ -316,29 +395,34 @@ def run(model="gpt-4o-mini", whole_max=8000, window_tokens=1800):
     
     all_mentions = dedup_mentions(all_mentions)
     dedup_removed_pct = round(100 * (1 - len(all_mentions) / max(1, pre_count)), 1)
-    ambiguity_pct = round(
-        100 * sum(1 for m in all_mentions if m.get("confidence", 0) < 0.6) / max(1, len(all_mentions)),
-        1,
-    )
+    # все счётчики статистики — за один проход
+    by_label = Counter()
+    low_conf = with_quote = 0
+    for m in all_mentions:
+        by_label[m["label_type"]] += 1
+        low_conf += m.get("confidence", 0) < 0.6
+        with_quote += bool(m.get("text_quote"))
+    ambiguity_pct = round(100 * low_conf / max(1, len(all_mentions)), 1)
     
     print(f"🧹 После дедупликации: {len(all_mentions)} упоминаний")
     print(f"📈 Удалено дубликатов: {dedup_removed_pct}%")
     print(f"⚠️  Низкоуверенных: {ambiguity_pct}%")
 
-    # запишем артефакты
-    RES_PATH.write_text(
-        json.dumps({"mentions": all_mentions}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    # запишем артефакты: json.dump пишет кусками, без одной гигантской строки;
+    # через tmp + replace дашборд/API не увидят недописанный файл
+    tmp = RES_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"mentions": all_mentions}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, RES_PATH)
 
     # пересчёт статистики
     stats = {
         "dialogs": int(df["dialog_id"].nunique()),
         "mentions": len(all_mentions),
-        "problems": sum(1 for m in all_mentions if m["label_type"] == "problems"),
-        "ideas": sum(1 for m in all_mentions if m["label_type"] == "ideas"),
-        "signals": sum(1 for m in all_mentions if m["label_type"] == "signals"),
-        "evidence_100": (len(all_mentions) > 0 and all(m.get("text_quote") for m in all_mentions)),
+        "problems": by_label["problems"],
+        "ideas": by_label["ideas"],
+        "signals": by_label["signals"],
+        "evidence_100": (len(all_mentions) > 0 and with_quote == len(all_mentions)),
         "dedup_removed_pct": dedup_removed_pct,
         "ambiguity_pct": ambiguity_pct,
     }
@@ -350,5 +434,8 @@ if __name__ == "__main__":
     ap.add_argument("--model", default="gpt-4o-mini")
     ap.add_argument("--whole_max", type=int, default=8000)
     ap.add_argument("--window_tokens", type=int, default=1800)
+    ap.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY,
+                    help="сколько диалогов обрабатывать параллельно (env OPENAI_MAX_CONCURRENCY)")
     args = ap.parse_args()
-    run(model=args.model, whole_max=args.whole_max, window_tokens=args.window_tokens)
\ No newline at end of file
+    run(model=args.model, whole_max=args.whole_max, window_tokens=args.window_tokens,
+        concurrency=max(1, args.concurrency))
\ No newline at end of file
@@ -18,8 +18,9 @@
   dialogs, mentions, share_dialogs_pct, freq_per_1k, intensity_mpd
 """
 
-import os, json, yaml, httpx
+import os, json, time, random, yaml, httpx
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, Tuple
 
@@ -33,6 +34,14 @@ MAPS = {
     "ideas":    "idea_map.yaml",
     "signals":  "signal_map.yaml",
 }
+SINGULAR = {"problems":"problem","ideas":"idea","signals":"signal"}
+LABEL_RU = {"problems":"ПРОБЛЕМА","ideas":"ИДЕЯ","signals":"СИГНАЛ"}
+
+# ---- LLM: таймауты и предохранитель
+CARDS_TIMEOUT = httpx.Timeout(connect=10.0, read=60.0, write=30.0, pool=None)
+CARDS_MAX_FAILURES = 3  # подряд неудачных запросов — дальше карточки не запрашиваем
+CARDS_CONCURRENCY = max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")))
+CARDS_MAX_RETRIES = 4  # 429/5xx и обрывы сети повторяем, прежде чем считать отказом
 
 # ---- utils
 def _load_mentions() -> pd.DataFrame:
@@ -77,7 +86,7 @@ def _consolidate_one(
     m_all: pd.DataFrame, kind: str, map_path: str
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """Возвращает (merged, summary, subthemes) и пишет CSV."""
-    singular = {"problems":"problem","ideas":"idea","signals":"signal"}[kind]
+    singular = SINGULAR[kind]
     id_col = f"{singular}_id"
     title_col = f"{singular}_title"
 
@@ -126,6 +135,20 @@ def _consolidate_one(
     return merged, agg, sub
 
 # ---- авто-карточки (по желанию)
+def _parse_card(data) -> dict:
+    """Карточка из ответа chat/completions; любой не тот формат — ValueError."""
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        raise ValueError("неожиданный формат ответа API") from None
+    if not isinstance(content, str):
+        # content=null — отказ модели под json_object
+        raise ValueError("пустой ответ модели")
+    card = json.loads(content)
+    if not isinstance(card, dict):
+        raise ValueError("карточка — не JSON-объект")
+    return card
+
 SYS_TMPL = (
     "Ты пишешь краткую карточку на русском для {label_ru} на основе статистики и цитат. "
     "Без советов. Ответ строго JSON."
@@ -161,27 +184,32 @@ intensity_mpd: {intensity:.2f}
 }}
 """
 
-def _summarize_cards(kind: str, merged: pd.DataFrame, agg: pd.DataFrame, sub: pd.DataFrame, model="gpt-4o-mini"):
+def _summarize_cards(kind: str, merged: pd.DataFrame, agg: pd.DataFrame, sub: pd.DataFrame,
+                     client: httpx.Client, model="gpt-4o-mini") -> bool:
+    """Пишет карточки; возвращает False, если сработал предохранитель (API недоступно)."""
     key = os.getenv("OPENAI_API_KEY", "")
     if not key:
         print(f"[warn] OPENAI_API_KEY не задан — пропускаю карточки для {kind}.")
-        return
+        return True
 
-    singular = {"problems":"problem","ideas":"idea","signals":"signal"}[kind]
+    singular = SINGULAR[kind]
     id_col = f"{singular}_id"
     title_col = f"{singular}_title"
-    label_ru = {"problems":"ПРОБЛЕМА","ideas":"ИДЕЯ","signals":"СИГНАЛ"}[kind]
+    label_ru = LABEL_RU[kind]
     out_path_jsonl = ART / f"{singular}_cards.jsonl"
     out_path_csv   = ART / f"{singular}_cards.csv"
 
-    client = httpx.Client(timeout=60)
-    out = []
+    jobs = []
+
+    # строки по id разбираем один раз, а не фильтруем merged/sub на каждую карточку
+    merged_by_id = dict(tuple(merged.groupby(id_col, sort=False)))
+    sub_by_id = dict(tuple(sub.groupby(id_col, sort=False)))
 
     data_iter = agg[agg[id_col] != "other_unmapped"].sort_values("dialogs", ascending=False)
     for _, row in data_iter.iterrows():
         oid, title = row[id_col], row[title_col]
-        dfp = merged[merged[id_col] == oid]
-        subp = sub[sub[id_col] == oid].head(5)
+        dfp = merged_by_id[oid]
+        subp = sub_by_id[oid].head(5)
         top_sub = "\n".join([f"- {r.theme} / {r.subtheme} — dlg={r.dialogs} / m={r.mentions}" for r in subp.itertuples()])
         sample = dfp.sample(n=min(6, len(dfp)), random_state=42)
         quotes = "\n".join([
@@ -212,28 +240,77 @@ def _summarize_cards(kind: str, merged: pd.DataFrame, agg: pd.DataFrame, sub: pd
                 {"role": "user", "content": user},
             ],
         }
-        r = client.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
-            json=payload,
-        )
-        r.raise_for_status()
-        js = json.loads(r.json()["choices"][0]["message"]["content"])
-        out.append(js)
-
-    if out:
+        jobs.append((oid, payload))
+
+    def _request(payload):
+        headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+        for attempt in range(1, CARDS_MAX_RETRIES + 1):
+            try:
+                r = client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+                r.raise_for_status()
+                return _parse_card(r.json())
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+                if attempt == CARDS_MAX_RETRIES:
+                    raise
+                sleep = min(60.0, 1.5 ** attempt + random.uniform(0, 0.5))
+                reason = type(e).__name__
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in (429, 500, 502, 503, 504) or attempt == CARDS_MAX_RETRIES:
+                    raise
+                sleep = min(60.0, 1.5 ** attempt + random.uniform(0, 0.5))
+                # параллельные запросы легко ловят 429 — ждём, сколько просит сервер
+                try:
+                    sleep = min(60.0, max(sleep, float(e.response.headers.get("retry-after", 0))))
+                except ValueError:
+                    pass
+                reason = str(e.response.status_code)
+            print(f"[warn] {reason} (попытка {attempt}/{CARDS_MAX_RETRIES}), повтор через {sleep:.1f}s")
+            time.sleep(sleep)
+
+    # запросы карточек независимы — отправляем параллельно
+    cards = {}
+    failed = []
+    failures = 0
+    with ThreadPoolExecutor(max_workers=CARDS_CONCURRENCY) as pool:
+        futures = {pool.submit(_request, payload): oid for oid, payload in jobs}
+        for fut in as_completed(futures):
+            oid = futures[fut]
+            try:
+                cards[oid] = fut.result()
+            except (httpx.HTTPError, ValueError) as e:
+                failed.append(oid)
+                failures += 1
+                print(f"[warn] карточка {oid}: {type(e).__name__} ({failures}/{CARDS_MAX_FAILURES})")
+                if failures >= CARDS_MAX_FAILURES:
+                    print("[warn] ошибки подряд — прекращаю запрашивать карточки.")
+                    for f in futures:
+                        f.cancel()
+                    break
+                continue
+            failures = 0
+
+    # порядок как в сводке — по числу звонков
+    out = [cards[oid] for oid, _ in jobs if oid in cards]
+    if failures >= CARDS_MAX_FAILURES or failed:
+        # неполный набор не пишем поверх прежних карточек
+        print(f"[warn] карточки {kind} не обновлены: получено {len(out)} из {len(jobs)}")
+    elif out:
         out_path_jsonl.write_text("\n".join([json.dumps(x, ensure_ascii=False) for x in out]), encoding="utf-8")
         pd.DataFrame(out).to_csv(out_path_csv, index=False)
         print(f"[ok] карточки {kind} -> {out_path_jsonl}, {out_path_csv}")
+    return failures < CARDS_MAX_FAILURES
 
 def main():
     m_all = _load_mentions()
-    # прогон по всем типам
-    for kind, map_path in MAPS.items():
-        merged, agg, sub = _consolidate_one(m_all, kind, map_path)
-        print(f"[ok] {kind}: dialogs={agg['dialogs'].sum() if not agg.empty else 0}, rows={len(agg)}")
-        if not agg.empty:
-            _summarize_cards(kind, merged, agg, sub)
+    cards_ok = True
+    # один клиент на все типы — keep-alive соединение с API переиспользуется
+    with httpx.Client(timeout=CARDS_TIMEOUT) as client:
+        # прогон по всем типам
+        for kind, map_path in MAPS.items():
+            merged, agg, sub = _consolidate_one(m_all, kind, map_path)
+            print(f"[ok] {kind}: dialogs={agg['dialogs'].sum() if not agg.empty else 0}, rows={len(agg)}")
+            if not agg.empty and cards_ok:
+                cards_ok = _summarize_cards(kind, merged, agg, sub, client)
 
     print("[ok] artifacts/* для problems/ideas/signals готовы")
 
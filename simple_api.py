@@ -3,7 +3,6 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
 import json
-import pandas as pd
 
 app = FastAPI(title="DialogsRAG API", version="2.0")
 
@@ -21,18 +20,28 @@ RES_PATH = ART / "comprehensive_results.json"
 STATS_PATH = ART / "statistics.json"
 
 # ---------- helpers ----------
+# Кэш разобранных JSON-файлов: ключ — (mtime_ns, size), поэтому повторные
+# запросы не перечитывают файл, а новая выгрузка анализатора подхватывается сразу.
+_JSON_CACHE = {}
+
+def read_json_cached(path: Path, default):
+    if not path.exists():
+        return default
+    st = path.stat()
+    sig = (st.st_mtime_ns, st.st_size)
+    hit = _JSON_CACHE.get(path)
+    if hit is None or hit[0] != sig:
+        hit = (sig, json.loads(path.read_text(encoding="utf-8")))
+        _JSON_CACHE[path] = hit
+    return hit[1]
+
 def read_mentions():
-    if not RES_PATH.exists():
-        return []
-    js = json.loads(RES_PATH.read_text(encoding="utf-8"))
-    return js.get("mentions", [])
+    return read_json_cached(RES_PATH, {}).get("mentions", [])
 
 # ---------- base endpoints ----------
 @app.get("/api/statistics")
 def statistics():
-    if not STATS_PATH.exists():
-        return {}
-    return json.loads(STATS_PATH.read_text(encoding="utf-8"))
+    return read_json_cached(STATS_PATH, {})
 
 @app.get("/api/mentions")
 def mentions(limit: int = 1000, offset: int = 0, label_type: str | None = None):
@@ -44,8 +53,10 @@ def mentions(limit: int = 1000, offset: int = 0, label_type: str | None = None):
         "items": arr[offset: offset + limit]
     }
 
+# pandas нужен только агрегатам ниже — импортируем там, а не при старте API
 @app.get("/api/summary_themes")
 def summary_themes():
+    import pandas as pd
     df = pd.DataFrame(read_mentions())
     if df.empty:
         return {"by_label": []}
@@ -56,35 +67,33 @@ def summary_themes():
     )
     return {"by_label": grp.to_dict(orient="records")}
 
+# Простая фильтрация по типу — без pandas: DataFrame здесь только копировал бы
+# все упоминания и подставлял NaN вместо отсутствующих ключей.
+def _items_of(label_type: str):
+    return {"items": [m for m in read_mentions() if m.get("label_type") == label_type]}
+
 @app.get("/api/problems")
 def problems():
-    df = pd.DataFrame(read_mentions())
-    if df.empty:
-        return {"items": []}
-    return {"items": df[df["label_type"] == "problems"].to_dict(orient="records")}
+    return _items_of("problems")
 
 @app.get("/api/ideas")
 def ideas():
-    df = pd.DataFrame(read_mentions())
-    if df.empty:
-        return {"items": []}
-    return {"items": df[df["label_type"] == "ideas"].to_dict(orient="records")}
+    return _items_of("ideas")
 
 @app.get("/api/signals")
 def signals():
-    df = pd.DataFrame(read_mentions())
-    if df.empty:
-        return {"items": []}
-    return {"items": df[df["label_type"] == "signals"].to_dict(orient="records")}
+    return _items_of("signals")
 
 @app.post("/api/reload")
 def reload_data():
-    # Источник — файлы, поэтому reload по сути no-op, но оставим для совместимости
+    # Источник — файлы; кэш сам сверяет mtime, но сбросим его явно
+    _JSON_CACHE.clear()
     return {"status": "ok"}
 
 # ---------- consolidation endpoints ----------
 @app.get("/api/problems_consolidated")
 def problems_consolidated():
+    import pandas as pd
     ps = ART / "problems_summary.csv"
     sub = ART / "problems_subthemes.csv"
     if not ps.exists():
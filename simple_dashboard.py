@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import io
 import json
+import re
 from pathlib import Path
 from urllib.parse import urlencode
 
@@ -55,6 +57,13 @@ SG_IDX = ART / "signals_mentions.csv"
 SG_CARDS = ART / "signal_cards.jsonl"
 
 PALETTE = {"problems": "#e74c3c", "ideas": "#f1c40f", "signals": "#3498db"}
+LABEL_TITLES = {"problems": "Проблемы", "ideas": "Идеи", "signals": "Сигналы"}
+# (summary, subthemes, mentions_idx, cards) по типу сущности
+ARTIFACT_PATHS = {
+    "problems": (PM_SUM, PM_SUB, PM_IDX, PM_CARDS),
+    "ideas": (ID_SUM, ID_SUB, ID_IDX, ID_CARDS),
+    "signals": (SG_SUM, SG_SUB, SG_IDX, SG_CARDS),
+}
 
 # ---------- helpers ----------
 
@@ -72,7 +81,9 @@ def _set_query_params(params: dict):
         st.experimental_set_query_params(**params)
 
 
-@st.cache_data(show_spinner=False)
+# Большие таблицы держим через cache_resource: cache_data отдаёт копию (pickle)
+# на каждый rerun. Код ниже эти DataFrame только читает — не мутировать!
+@st.cache_resource(show_spinner=False)
 def load_mentions() -> pd.DataFrame:
     if not RES_PATH.exists():
         return pd.DataFrame(columns=["dialog_id","turn_id","label_type","theme","subtheme","text_quote","confidence"])
@@ -96,14 +107,10 @@ def load_stats() -> dict:
     return json.loads(STATS_PATH.read_text(encoding="utf-8"))
 
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def load_artifacts(prefix: str):
     # Возвращает (summary, subthemes, mentions_idx, cards_df)
-    paths = {
-        "problems": (PM_SUM, PM_SUB, PM_IDX, PM_CARDS),
-        "ideas": (ID_SUM, ID_SUB, ID_IDX, ID_CARDS),
-        "signals": (SG_SUM, SG_SUB, SG_IDX, SG_CARDS),
-    }[prefix]
+    paths = ARTIFACT_PATHS[prefix]
     sum_df = pd.read_csv(paths[0]) if paths[0].exists() else pd.DataFrame()
     sub_df = pd.read_csv(paths[1]) if paths[1].exists() else pd.DataFrame()
     idx_df = pd.read_csv(paths[2]) if paths[2].exists() else pd.DataFrame()
@@ -114,8 +121,11 @@ def load_artifacts(prefix: str):
 def file_hash() -> str:
     parts = []
     for p in [RES_PATH, STATS_PATH, PM_SUM, PM_SUB, PM_IDX, PM_CARDS, ID_SUM, ID_SUB, ID_IDX, ID_CARDS, SG_SUM, SG_SUB, SG_IDX, SG_CARDS]:
-        if p.exists():
-            parts.append(f"{p.name}:{int(p.stat().st_mtime)}:{p.stat().st_size}")
+        try:
+            st_ = p.stat()
+        except FileNotFoundError:
+            continue
+        parts.append(f"{p.name}:{st_.st_mtime_ns}:{st_.st_size}")
     return str(hash("|".join(parts)))
 
 
@@ -133,14 +143,23 @@ def to_excel_bytes(df_dict: dict) -> bytes:
     return buf.getvalue()
 
 
-def highlight_html(text: str, q: str) -> str:
-    if not q: return text
-    try:
-        import re
-        pattern = re.compile(re.escape(q), re.IGNORECASE)
-        return pattern.sub(lambda m: f"<mark>{m.group(0)}</mark>", text)
-    except Exception:
-        return text
+# Ключ выгрузки задаёт вызывающий: подпись артефактов + какие строки попали в таблицу.
+# Сам DataFrame (_build) Streamlit не хеширует — большие фреймы он хеширует по выборке
+# строк, и выгрузка другой фильтрации могла бы вернуть чужие байты.
+@st.cache_data(show_spinner=False, max_entries=32)
+def export_bytes(key: tuple, _build) -> bytes:
+    return _build()
+
+
+def rows_key(df: pd.DataFrame) -> str:
+    return hashlib.blake2b(df.index.to_numpy().tobytes(), digest_size=16).hexdigest()
+
+
+def highlight_html(texts: pd.Series, q: str) -> pd.Series:
+    # паттерн компилируем один раз на весь столбец, замена — шаблоном без Python-колбэка
+    if not q: return texts
+    pattern = re.compile(re.escape(q), re.IGNORECASE)
+    return texts.astype(str).str.replace(pattern, r"<mark>\g<0></mark>", regex=True)
 
 
 def prettify_table(df: pd.DataFrame) -> pd.DataFrame:
@@ -168,7 +187,7 @@ elif st.session_state["_sig"] != sig:
     st.info("Обнаружены новые файлы отчётов. Нажмите, чтобы обновить экран.")
     if st.button("🔄 Обновить дашборд"):
         st.session_state["_sig"] = sig
-        st.cache_data.clear(); st.rerun()
+        st.cache_data.clear(); st.cache_resource.clear(); st.rerun()
 
 # ---------- sidebar ----------
 st.sidebar.header("Фильтры")
@@ -311,7 +330,7 @@ with tab_overview:
             if d.empty: 
                 st.caption(f"Нет данных для: {lbl}")
                 continue
-            title_lbl = {"problems":"Проблемы","ideas":"Идеи","signals":"Сигналы"}[lbl]
+            title_lbl = LABEL_TITLES[lbl]
             fig = px.bar(
                 d.sort_values("value"),
                 x="value", y="theme", orientation="h",
@@ -356,31 +375,32 @@ with tab_overview:
         hl = st.toggle("Подсветить слово поиска в цитатах", value=bool(search.strip()))
         table = df_f.sort_values(["label_type","theme","subtheme"]).reset_index(drop=True)
         if hl and search.strip():
-            t = table.copy(); t["text_quote"] = t["text_quote"].apply(lambda x: highlight_html(x, search))
+            t = table.copy(); t["text_quote"] = highlight_html(t["text_quote"], search)
             st.markdown(prettify_table(t).to_html(escape=False, index=False), unsafe_allow_html=True)
         else:
             st.dataframe(prettify_table(table), use_container_width=True, height=440)
         
         colx, coly = st.columns(2)
+        rk = rows_key(df_f)
         with colx:
-            st.download_button("⬇️ Скачать CSV (то, что на экране)", data=to_csv_bytes(table), file_name="mentions_filtered.csv", mime="text/csv")
+            st.download_button("⬇️ Скачать CSV (то, что на экране)", data=export_bytes((sig, "csv", rk), lambda: to_csv_bytes(table)),
+                               file_name="mentions_filtered.csv", mime="text/csv")
         with coly:
-            st.download_button("⬇️ Скачать Excel", data=to_excel_bytes({"Цитаты": prettify_table(table)}), file_name="mentions_filtered.xlsx",
+            st.download_button("⬇️ Скачать Excel", data=export_bytes((sig, "xlsx", rk), lambda: to_excel_bytes({"Цитаты": prettify_table(table)})),
+                               file_name="mentions_filtered.xlsx",
                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 # ===== RAW =====
 
 def render_raw(df_src: pd.DataFrame, label: str):
-    name = {"problems":"Проблемы","ideas":"Идеи","signals":"Сигналы"}[label]
+    name = LABEL_TITLES[label]
     st.info(f"Здесь список тем и цитат для: **{name}**. Слева можно сузить фильтры.")
     d = df_src[df_src["label_type"] == label]
     if d.empty:
         st.warning("Нет строк.")
         return
     c1, c2 = st.columns([1,1])
-    top_dialogs = d.groupby("theme")["dialog_id"].nunique().rename("Звонки")
-    top_mentions = d.groupby("theme")["text_quote"].count().rename("Фразы")
-    top = pd.concat([top_dialogs, top_mentions], axis=1).reset_index().fillna(0)
+    top = d.groupby("theme").agg(Звонки=("dialog_id", "nunique"), Фразы=("text_quote", "count")).reset_index()
     top = top.sort_values("Звонки", ascending=False).head(15)
     fig = px.bar(top.melt(id_vars="theme", value_vars=["Звонки","Фразы"]),
                  x="value", y="theme", color="variable", barmode="group",
@@ -413,9 +433,7 @@ def render_consolidation(prefix: str, title: str, icon: str):
     Ниже видно, какие из них встречаются чаще всего и из каких подтем они складываются.
     """)
     
-    sum_path = {
-        "problems": PM_SUM, "ideas": ID_SUM, "signals": SG_SUM
-    }[prefix]
+    sum_path = ARTIFACT_PATHS[prefix][0]
     
     if not sum_path.exists():
         st.warning(f"Нет artifacts/{prefix}_summary.csv — запустите consolidate_and_summarize.py")
@@ -460,13 +478,14 @@ def render_consolidation(prefix: str, title: str, icon: str):
             idx_id_col = pick_id_col(idx_df)
             
             g = idx_df.groupby(["theme","subtheme", idx_id_col, idx_title_col])['dialog_id'].nunique().reset_index(name="dialogs")
-            subs = g.apply(lambda r: f"{r['theme']} / {r['subtheme']}", axis=1).unique().tolist()
+            sub_lbl = g["theme"].astype(str) + " / " + g["subtheme"].astype(str)
+            subs = sub_lbl.unique().tolist()
             probs = g[idx_title_col].unique().tolist()
             nodes = subs + probs
             idx_map = {name: i for i, name in enumerate(nodes)}
-            src = [idx_map[f"{r.theme} / {r.subtheme}"] for r in g.itertuples()]
-            dst = [idx_map[getattr(r, idx_title_col)] for r in g.itertuples()]
-            val = [int(r.dialogs) for r in g.itertuples()]
+            src = sub_lbl.map(idx_map).tolist()
+            dst = g[idx_title_col].map(idx_map).tolist()
+            val = g["dialogs"].astype(int).tolist()
             sankey = go.Sankey(node=dict(label=nodes), link=dict(source=src, target=dst, value=val))
             st.plotly_chart(go.Figure(sankey), use_container_width=True)
         else:
@@ -491,11 +510,17 @@ def render_consolidation(prefix: str, title: str, icon: str):
                 st.dataframe(cand, use_container_width=True)
         
         st.subheader(f"Карточки {title.lower()} — человеческим языком")
+        # индексы по id один раз, а не полный проход таблиц на каждую карточку
+        cards_by_id = {}
+        if not cards_df.empty and id_col in cards_df.columns:
+            cards_by_id = {r[id_col]: r for _, r in cards_df.drop_duplicates(id_col).iterrows()}
+        subs_by_id = dict(tuple(sub_df.groupby(id_col, sort=False))) if not sub_df.empty else {}
+        idx_by_id = dict(tuple(idx_df.groupby(idx_id_col, sort=False))) if not idx_df.empty else {}
         for _, row in sum_df.sort_values("dialogs", ascending=False).iterrows():
             pid, title_text = row[id_col], row[title_col]
             with st.expander(f"{title_text} — {int(row['mentions'])} фраз · {int(row['dialogs'])} звонков ({row['share_dialogs_pct']}%)"):
-                if not cards_df.empty and pid in set(cards_df.get(id_col, pd.Series()).values):
-                    js = cards_df[cards_df[id_col] == pid].iloc[0]
+                if pid in cards_by_id:
+                    js = cards_by_id[pid]
                     st.markdown(f"**О чём речь.** {js.get('definition','')}")
                     st.markdown(f"**Почему это важно.** {js.get('why_it_matters','')}")
                     motifs = js.get("common_motifs", [])
@@ -505,13 +530,13 @@ def render_consolidation(prefix: str, title: str, icon: str):
                     if motifs: st.markdown("**Частые мотивы:** " + ", ".join(motifs))
                 if not sub_df.empty:
                     st.markdown("**Подтемы (топ):**")
-                    st.dataframe(sub_df[sub_df[id_col] == pid].head(10), use_container_width=True)
+                    st.dataframe(subs_by_id.get(pid, sub_df.iloc[:0]).head(10), use_container_width=True)
                 if not idx_df.empty:
                     st.markdown("**Примеры фраз:**")
                     cols = ["dialog_id","turn_id","theme","subtheme","text_quote","confidence"]
-                    st.dataframe(prettify_table(idx_df[idx_df[idx_id_col] == pid][cols]).rename(columns={"ID звонка":"dialog_id"}),
+                    st.dataframe(prettify_table(idx_by_id.get(pid, idx_df.iloc[:0])[cols]).rename(columns={"ID звонка":"dialog_id"}),
                                  use_container_width=True)
-        st.download_button(f"⬇️ Скачать CSV со сводкой {title.lower()}", data=to_csv_bytes(sum_df), file_name=f"{prefix}_summary.csv", mime="text/csv")
+        st.download_button(f"⬇️ Скачать CSV со сводкой {title.lower()}", data=export_bytes((sig, f"{prefix}_summary"), lambda: to_csv_bytes(sum_df)), file_name=f"{prefix}_summary.csv", mime="text/csv")
 
 with tab_problems_cons: render_consolidation("problems", "Сводка по проблемам", "🚫")
 with tab_ideas_cons: render_consolidation("ideas", "Сводка по идеям", "💡")
@@ -526,27 +551,22 @@ with tab_links:
     if df_f.empty:
         st.warning("Нет данных.")
     else:
-        per_dialog = df_f.groupby(["dialog_id","theme"]).size().reset_index().drop(columns=0)
+        per_dialog = df_f[["dialog_id","theme"]].drop_duplicates()
         themes = sorted(per_dialog["theme"].unique())
-        idx_map = {t:i for i,t in enumerate(themes)}
         n = len(themes)
-        mat = np.zeros((n,n), dtype=int)
-        for _, g in per_dialog.groupby("dialog_id"):
-            ts = sorted(set(g["theme"]))
-            for i in range(len(ts)):
-                for j in range(i, len(ts)):
-                    a, b = idx_map[ts[i]], idx_map[ts[j]]
-                    mat[a,b] += 1
-                    if a!=b: mat[b,a] += 1
+        # матрица звонок×тема из 0/1: совместная встречаемость = Xᵀ·X (диагональ — звонки с темой)
+        onehot = pd.crosstab(per_dialog["dialog_id"], per_dialog["theme"]).reindex(columns=themes, fill_value=0)
+        x = onehot.to_numpy(dtype=np.int64)
+        mat = x.T @ x
         fig = px.imshow(mat, x=themes, y=themes, aspect="auto", color_continuous_scale="Reds", origin="lower")
         fig.update_layout(xaxis_tickangle=45)
         st.plotly_chart(fig, use_container_width=True)
         
-        pairs = []
-        for i in range(n):
-            for j in range(i+1, n):
-                pairs.append((themes[i], themes[j], int(mat[i,j])))
-        pairs_df = pd.DataFrame(pairs, columns=["Тема A","Тема B","Звонки вместе"]).sort_values("Звонки вместе", ascending=False).head(20)
+        ia, ib = np.triu_indices(n, k=1)
+        themes_arr = np.asarray(themes, dtype=object)
+        pairs_df = pd.DataFrame({
+            "Тема A": themes_arr[ia], "Тема B": themes_arr[ib], "Звонки вместе": mat[ia, ib],
+        }).sort_values("Звонки вместе", ascending=False).head(20)
         st.dataframe(pairs_df, use_container_width=True)
 
 # ===== Качество =====
@@ -561,7 +581,7 @@ with tab_quality:
         fig = px.histogram(df_f, x="confidence", color="label_type", nbins=20, barmode="overlay", color_discrete_map=PALETTE)
         fig.update_layout(xaxis_title="Надёжность (0…1)", yaxis_title="Сколько фраз")
         st.plotly_chart(fig, use_container_width=True)
-        low = (df_f["confidence"] < 0.6).mean()*100
-        med = df_f["confidence"].median()
-        p90 = df_f["confidence"].quantile(0.9)
+        conf = df_f["confidence"].to_numpy(dtype=float)  # NaN уже заменены на 0 при загрузке
+        low = (conf < 0.6).mean()*100
+        med, p90 = np.quantile(conf, [0.5, 0.9])
         st.caption(f"Меньше 0.6: {low:.1f}%  •  Медиана: {med:.2f}  •  90-й перцентиль: {p90:.2f}")
\ No newline at end of file